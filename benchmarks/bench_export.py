@@ -0,0 +1,55 @@
+# benchmarks/bench_export.py
+# قياس سرعة تصدير السجل (صفوف/ثانية) وذروة الذاكرة لصيغ CSV و NDJSON و gzip.
+# الاستخدام: python benchmarks/bench_export.py [عدد الصفقات]
+import os
+import sys
+import time
+import tempfile
+import tracemalloc
+from datetime import datetime, timedelta
+
+_db_dir = tempfile.mkdtemp(prefix="market_signals_bench_")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_db_dir, 'bench.db')}"
+os.environ["BACKGROUND_SCHEDULER"] = "0"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import market_signals_bot as bot
+
+def seed_trades(count):
+    start = datetime(2024, 1, 1)
+    with bot.engine.begin() as conn:
+        user_id = conn.execute(bot.User.__table__.insert().values(telegram_id="1")).inserted_primary_key[0]
+        rows = [
+            {
+                "user_id": user_id,
+                "strategy": "strategy_advanced",
+                "symbol": ("BTC-USDT", "ETH-USDT", "XRP-USDT")[i % 3],
+                "open_time": start + timedelta(minutes=i),
+                "open_price": 100.0 + i % 50,
+                "status": "closed",
+                "result": "win" if i % 2 else "loss",
+            }
+            for i in range(count)
+        ]
+        conn.execute(bot.Trade.__table__.insert(), rows)
+
+def run(label, make_chunks, count):
+    # تمريرة للسرعة دون tracemalloc (يبطئ التنفيذ)، ثم تمريرة لذروة الذاكرة
+    started = time.perf_counter()
+    size = sum(len(chunk) for chunk in make_chunks())
+    elapsed = time.perf_counter() - started
+    tracemalloc.start()
+    for _ in make_chunks():
+        pass
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<10} {count/elapsed:>12,.0f} rows/s  {size/1e6:>8.1f} MB  peak {peak/1e6:>6.1f} MB")
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    seed_trades(count)
+    print(f"trades={count} batch={bot.EXPORT_BATCH_SIZE}")
+    run("csv", lambda: bot.iter_export_chunks("trades", "csv"), count)
+    run("ndjson", lambda: bot.iter_export_chunks("trades", "ndjson"), count)
+    run("csv.gz", lambda: bot.gzip_stream(bot.iter_export_chunks("trades", "csv")), count)
+    run("ndjson.gz", lambda: bot.gzip_stream(bot.iter_export_chunks("trades", "ndjson")), count)
@@ -0,0 +1,251 @@
+# market_signals_async.py
+# نقطة تشغيل غير متزامنة (asyncio) لنفس البوت: Webhooks تليجرام و NowPayments
+# مع عميل HTTP مشترك بمجمع اتصالات، وأعمال قاعدة البيانات في Executor محدود.
+import os
+import json
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import aiohttp
+from aiohttp import web
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from query_profiler import QueryStats, collect_queries, report_query_stats
+
+# مهام المراقبة والتقرير اليومي تعمل هنا من حلقة الأحداث بدلاً من BackgroundScheduler
+os.environ.setdefault("BACKGROUND_SCHEDULER", "0")
+
+from market_signals_bot import (
+    TELEGRAM_API_URL,
+    WEBHOOK_ROUTE,
+    NOWPAYMENTS_ROUTE,
+    NOWPAYMENTS_IPN_SECRET,
+    PORT,
+    ADAPTIVE_TICK_SECONDS,
+    split_digest,
+    market_chart_url,
+    parse_market_chart,
+    signal_from_ohlcv,
+    nowpayments_invoice_request,
+    invoice_reply_text,
+    advice_reply_text,
+    expire_subscriptions,
+    plan_price_polls,
+    record_price_polls,
+    build_daily_report,
+    handle_telegram_update,
+    process_nowpayments_ipn,
+)
+
+# ===========================
+# الإعدادات
+# ===========================
+DB_WORKERS = int(os.getenv("DB_WORKERS", 8))
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 100))
+HTTP_TIMEOUT = aiohttp.ClientTimeout(total=5)
+TELEGRAM_MESSAGES_PER_SECOND = float(os.getenv("TELEGRAM_MESSAGES_PER_SECOND", 25))
+
+db_executor = None           # يُنشأ مع بدء التطبيق في http_client_ctx
+_status_update_task = None  # تحديث حالة التوصيات الجاري (مشترك بين الطلبات المتزامنة)
+_next_send_slot = 0.0       # أقرب موعد (loop.time) لإرسال رسالة تليجرام التالية
+
+def run_db(func, *args, stats=None):
+    # تشغيل عمل متزامن (قاعدة البيانات) في الـ Executor المحدود دون حجز حلقة الأحداث،
+    # مع احتساب استعلاماته ضمن QueryStats الطلب إن وُجد
+    def call():
+        if stats is None:
+            return func(*args)
+        with collect_queries(stats):
+            return func(*args)
+    return asyncio.get_running_loop().run_in_executor(db_executor, call)
+
+# ===========================
+# وظائف HTTP غير متزامنة
+# ===========================
+async def _wait_for_send_slot():
+    # توزيع الرسائل على فترات متساوية لعدم تجاوز حد تليجرام (~30 رسالة/ثانية)،
+    # الحجز يتم دون await بينه وبين القراءة فلا يحتاج قفلاً داخل حلقة الأحداث
+    global _next_send_slot
+    now = asyncio.get_running_loop().time()
+    slot = max(now, _next_send_slot)
+    _next_send_slot = slot + 1 / TELEGRAM_MESSAGES_PER_SECOND
+    if slot > now:
+        await asyncio.sleep(slot - now)
+
+def _retry_after(body):
+    try:
+        return json.loads(body).get("parameters", {}).get("retry_after", 1)
+    except ValueError:
+        return 1
+
+async def send_message_async(http, chat_id, text, retry=True):
+    url = f"{TELEGRAM_API_URL}/sendMessage"
+    payload = {"chat_id": chat_id, "text": text}
+    await _wait_for_send_slot()
+    try:
+        async with http.post(url, json=payload) as resp:
+            status = resp.status
+            body = await resp.read()
+    except Exception as e:
+        print(f"خطأ في إرسال رسالة: {e}")
+        return
+    if status == 429 and retry:
+        # إعادة المحاولة مرة واحدة بعد المهلة التي يطلبها تليجرام
+        retry_after = _retry_after(body)
+        print(f"تليجرام طلب التمهل {retry_after} ثانية للمحادثة {chat_id}")
+        await asyncio.sleep(retry_after)
+        await send_message_async(http, chat_id, text, retry=False)
+    elif status >= 300:
+        print(f"خطأ في إرسال رسالة إلى {chat_id}: HTTP {status} {body[:200]!r}")
+
+async def send_digest_async(http, chat_id, lines):
+    for chunk in split_digest(lines):
+        await send_message_async(http, chat_id, chunk)
+
+async def get_current_price_async(http, symbol):
+    try:
+        coin = symbol.split("-")[0].lower()
+        url = f"https://api.coingecko.com/api/v3/simple/price?ids={coin}&vs_currencies=usd"
+        async with http.get(url) as resp:
+            resp.raise_for_status()
+            data = await resp.json()
+            return data.get(coin, {}).get("usd", 0)
+    except Exception:
+        return 0
+
+async def check_signal_async(http, symbol):
+    try:
+        async with http.get(market_chart_url(symbol)) as resp:
+            resp.raise_for_status()
+            df = parse_market_chart(await resp.json())
+    except Exception as e:
+        print(f"خطأ في جلب OHLCV لـ {symbol}: {e}")
+        return False
+    return signal_from_ohlcv(df)
+
+async def create_nowpayments_invoice_async(http, telegram_id, amount_usd):
+    url, headers, data = nowpayments_invoice_request(telegram_id, amount_usd)
+    try:
+        async with http.post(url, headers=headers, json=data) as resp:
+            if resp.status == 201:
+                invoice = await resp.json()
+                return invoice.get("invoice_url")
+    except Exception as e:
+        print(f"خطأ في إنشاء فاتورة NowPayments: {e}")
+    return None
+
+async def resolve_reply_async(http, reply_text):
+    # نفس resolve_reply لكن الطلبات الخارجية عبر aiohttp خارج الـ Executor
+    if isinstance(reply_text, str):
+        return reply_text
+    kind, *args = reply_text
+    if kind == "invoice":
+        return invoice_reply_text(await create_nowpayments_invoice_async(http, *args))
+    signals = await asyncio.gather(*(check_signal_async(http, sym) for sym in args[0]))
+    return advice_reply_text([sym for sym, ok in zip(args[0], signals) if ok])
+
+async def reply_async(http, chat_id, reply_text):
+    await send_message_async(http, chat_id, await resolve_reply_async(http, reply_text))
+
+# ===========================
+# إدارة التوصيات وإشعارات TP/SL
+# ===========================
+async def _update_recommendations_status(http):
+    # نفس المراقبة المتكيفة وميزانية الطلبات المشتركة في وضع Flask
+    stats = QueryStats("adaptive_monitor_tick")
+    try:
+        symbols = await run_db(plan_price_polls, stats=stats)
+        if not symbols:
+            return
+        prices = await asyncio.gather(*(get_current_price_async(http, s) for s in symbols))
+        notifications = await run_db(record_price_polls, dict(zip(symbols, prices)), stats=stats)
+    finally:
+        report_query_stats(stats)
+    await asyncio.gather(*(send_digest_async(http, chat_id, events)
+                           for chat_id, events in notifications.items()))
+
+async def update_recommendations_status_async(http):
+    # الطلبات المتزامنة تنتظر نفس التحديث الجاري بدلاً من تكرار جلب الأسعار
+    global _status_update_task
+    if _status_update_task is None or _status_update_task.done():
+        _status_update_task = asyncio.ensure_future(_update_recommendations_status(http))
+    await asyncio.shield(_status_update_task)
+
+async def send_daily_report_async(http):
+    stats = QueryStats("send_daily_report")
+    try:
+        chat_ids, report_text = await run_db(build_daily_report, stats=stats)
+    finally:
+        report_query_stats(stats)
+    await asyncio.gather(*(send_message_async(http, chat_id, report_text) for chat_id in chat_ids))
+
+# ===========================
+# Webhooks
+# ===========================
+async def telegram_webhook(request):
+    http = request.app["http"]
+    stats = QueryStats("telegram_webhook")
+    try:
+        await run_db(expire_subscriptions, stats=stats)
+        await update_recommendations_status_async(http)
+        try:
+            update = await request.json()
+        except ValueError:
+            update = None
+        replies = await run_db(handle_telegram_update, update, stats=stats)
+    finally:
+        report_query_stats(stats)
+    await asyncio.gather(*(reply_async(http, chat_id, text) for chat_id, text in replies))
+    return web.Response(text="ok")
+
+async def nowpayments_webhook(request):
+    signature = request.headers.get("x-nowpayments-sig")
+    if signature != NOWPAYMENTS_IPN_SECRET:
+        return web.Response(text="Unauthorized", status=401)
+    try:
+        data = await request.json()
+    except ValueError:
+        return web.json_response({"error":"Invalid JSON"}, status=400)
+    if not isinstance(data, dict):
+        return web.json_response({"error":"Invalid JSON"}, status=400)
+    stats = QueryStats("nowpayments_webhook")
+    try:
+        response, status, notification = await run_db(process_nowpayments_ipn, data, stats=stats)
+    finally:
+        report_query_stats(stats)
+    if notification:
+        await send_message_async(request.app["http"], *notification)
+    if isinstance(response, dict):
+        return web.json_response(response, status=status)
+    return web.Response(text=response, status=status)
+
+async def index(request):
+    return web.Response(text="Market Signals Bot is running.")
+
+# ===========================
+# تشغيل التطبيق
+# ===========================
+async def http_client_ctx(app):
+    global db_executor
+    db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
+    connector = aiohttp.TCPConnector(limit=HTTP_POOL_SIZE)
+    app["http"] = aiohttp.ClientSession(connector=connector, timeout=HTTP_TIMEOUT)
+    scheduler = AsyncIOScheduler()
+    scheduler.add_job(update_recommendations_status_async, trigger="interval",
+                      seconds=ADAPTIVE_TICK_SECONDS, args=[app["http"]])
+    scheduler.add_job(send_daily_report_async, trigger="cron", hour=4, minute=0,
+                      args=[app["http"]])  # 7 صباحاً السعودية = 4 UTC
+    scheduler.start()
+    yield
+    scheduler.shutdown(wait=False)
+    await app["http"].close()
+    db_executor.shutdown(wait=True)
+
+def create_app():
+    app = web.Application()
+    app.cleanup_ctx.append(http_client_ctx)
+    app.router.add_post(WEBHOOK_ROUTE, telegram_webhook)
+    app.router.add_post(NOWPAYMENTS_ROUTE, nowpayments_webhook)
+    app.router.add_get("/", index)
+    return app
+
+if __name__=="__main__":
+    web.run_app(create_app(), host="0.0.0.0", port=PORT)
@@ -1,14 +1,24 @@
 # market_signals_bot.py
 import os
+import io
+import csv
 import json
+import zlib
+import hmac
+import math
+import time
+import threading
+from collections import deque
 from datetime import datetime, timedelta
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 import requests
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Float, ForeignKey
-from sqlalchemy.orm import declarative_base, sessionmaker, relationship
+from sqlalchemy import create_engine, select, Index, Column, Integer, String, DateTime, Float, ForeignKey
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import declarative_base, sessionmaker, relationship, joinedload
 from apscheduler.schedulers.background import BackgroundScheduler
 import atexit
 import pandas as pd
+from query_profiler import install_query_profiler, profiled
 
 # ===========================
 # الإعدادات والمتغيرات البيئية
@@ -19,15 +29,24 @@ NOWPAYMENTS_IPN_SECRET = os.getenv("NOWPAYMENTS_IPN_SECRET")
 TELEGRAM_API_URL = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}"
 WEBHOOK_ROUTE = "/market-signals-bot/telegram-webhook"
 NOWPAYMENTS_ROUTE = "/market-signals-bot/nowpayments-webhook"
+EXPORT_ROUTE = "/market-signals-bot/admin/export/<kind>"
+ADMIN_API_KEY = os.getenv("ADMIN_API_KEY")
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 1000))
 PORT = int(os.getenv("PORT", 5000))
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+ADAPTIVE_TICK_SECONDS = int(os.getenv("ADAPTIVE_TICK_SECONDS", 5))
+MIN_POLL_SECONDS = int(os.getenv("MIN_POLL_SECONDS", 5))
+MAX_POLL_SECONDS = int(os.getenv("MAX_POLL_SECONDS", 300))
+PRICE_REQUESTS_PER_MINUTE = int(os.getenv("PRICE_REQUESTS_PER_MINUTE", 30))
 
 # ===========================
 # إعداد قاعدة البيانات
 # ===========================
-DATABASE_URL = "sqlite:///./market_signals_bot.db"
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./market_signals_bot.db")
 Base = declarative_base()
 engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
 SessionLocal = sessionmaker(bind=engine)
+install_query_profiler(engine)
 
 class User(Base):
     __tablename__ = "users"
@@ -67,8 +86,20 @@ class Trade(Base):
     tp1_reached = Column(Integer, default=0)  # علم للهدف الأول
     tp2_reached = Column(Integer, default=0)
     user = relationship("User")
+    # مراقبة الصفقات تستعلم عن الرموز المفتوحة كل بضع ثوانٍ
+    __table_args__ = (Index("ix_trades_status_symbol", "status", "symbol"),)
+
+class ProcessedPayment(Base):
+    # سجل مدفوعات NowPayments المعالجة لمنع تكرار التفعيل عند إعادة إرسال IPN
+    __tablename__ = "processed_payments"
+    id = Column(Integer, primary_key=True)
+    payment_id = Column(String, unique=True, index=True, nullable=False)
+    processed_at = Column(DateTime, default=datetime.utcnow)
 
 Base.metadata.create_all(bind=engine)
+# create_all لا يضيف الفهارس الجديدة إلى جداول موجودة مسبقاً
+for index in Trade.__table__.indexes:
+    index.create(bind=engine, checkfirst=True)
 
 # ===========================
 # Flask App
@@ -78,19 +109,23 @@ app = Flask(__name__)
 # ===========================
 # استراتيجية صارمة داخل الملف
 # ===========================
+def market_chart_url(symbol, limit=50):
+    coin = symbol.split("-")[0].lower()
+    return f"https://api.coingecko.com/api/v3/coins/{coin}/market_chart?vs_currency=usd&days={limit}&interval=daily"
+
+def parse_market_chart(data):
+    df = pd.DataFrame(data['prices'], columns=['timestamp','close'])
+    df['high'] = [x[1] for x in data['prices']]
+    df['low'] = [x[1] for x in data['prices']]
+    df['volume'] = [v[1] for v in data['total_volumes']]
+    df['close'] = df['close']
+    return df
+
 def fetch_ohlcv(symbol, limit=50):
     try:
-        coin = symbol.split("-")[0].lower()
-        url = f"https://api.coingecko.com/api/v3/coins/{coin}/market_chart?vs_currency=usd&days={limit}&interval=daily"
-        resp = requests.get(url, timeout=5)
+        resp = requests.get(market_chart_url(symbol, limit), timeout=5)
         resp.raise_for_status()
-        data = resp.json()
-        df = pd.DataFrame(data['prices'], columns=['timestamp','close'])
-        df['high'] = [x[1] for x in data['prices']]
-        df['low'] = [x[1] for x in data['prices']]
-        df['volume'] = [v[1] for v in data['total_volumes']]
-        df['close'] = df['close']
-        return df
+        return parse_market_chart(resp.json())
     except Exception as e:
         print(f"خطأ في جلب OHLCV لـ {symbol}: {e}")
         return pd.DataFrame()
@@ -112,7 +147,9 @@ def fibonacci_levels(df):
     }
 
 def check_signal(symbol):
-    df = fetch_ohlcv(symbol)
+    return signal_from_ohlcv(fetch_ohlcv(symbol))
+
+def signal_from_ohlcv(df):
     if df.empty or len(df) < 20:
         return False
     close = df['close']
@@ -146,6 +183,33 @@ def send_message(chat_id, text):
     except Exception as e:
         print(f"خطأ في إرسال رسالة: {e}")
 
+def split_digest(lines):
+    # دمج عدة إشعارات في أقل عدد من الرسائل دون تجاوز حد طول رسالة تليجرام
+    chunks = []
+    chunk = ""
+    for line in lines:
+        while len(line) > TELEGRAM_MAX_MESSAGE_LENGTH:
+            if chunk:
+                chunks.append(chunk)
+                chunk = ""
+            chunks.append(line[:TELEGRAM_MAX_MESSAGE_LENGTH])
+            line = line[TELEGRAM_MAX_MESSAGE_LENGTH:]
+        if not line:
+            continue
+        candidate = f"{chunk}\n\n{line}" if chunk else line
+        if len(candidate) > TELEGRAM_MAX_MESSAGE_LENGTH:
+            chunks.append(chunk)
+            chunk = line
+        else:
+            chunk = candidate
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+def send_digest(chat_id, lines):
+    for chunk in split_digest(lines):
+        send_message(chat_id, chunk)
+
 def get_user(session, telegram_id, create_if_not_exist=True, user_info=None):
     user = session.query(User).filter_by(telegram_id=str(telegram_id)).first()
     if not user and create_if_not_exist:
@@ -191,7 +255,8 @@ def expire_subscriptions():
     session.commit()
     session.close()
 
-def create_nowpayments_invoice(telegram_id, amount_usd, currency="usdt", pay_currency="usdt"):
+def nowpayments_invoice_request(telegram_id, amount_usd, pay_currency="usdt"):
+    # (url, headers, data) لطلب إنشاء الفاتورة، مشتركة بين الوضعين المتزامن وغير المتزامن
     url = "https://api.nowpayments.io/v1/invoice"
     headers = {
         "x-api-key": NOWPAYMENTS_API_KEY,
@@ -205,7 +270,15 @@ def create_nowpayments_invoice(telegram_id, amount_usd, currency="usdt", pay_cur
         "order_id": str(telegram_id),
         "ipn_callback_url": f"https://market-signals-bot.onrender.com{NOWPAYMENTS_ROUTE}",
     }
-    response = requests.post(url, headers=headers, json=data)
+    return url, headers, data
+
+def create_nowpayments_invoice(telegram_id, amount_usd, currency="usdt", pay_currency="usdt"):
+    url, headers, data = nowpayments_invoice_request(telegram_id, amount_usd, pay_currency)
+    try:
+        response = requests.post(url, headers=headers, json=data, timeout=5)
+    except Exception as e:
+        print(f"خطأ في إنشاء فاتورة NowPayments: {e}")
+        return None
     if response.status_code == 201:
         invoice = response.json()
         return invoice.get("invoice_url")
@@ -225,40 +298,193 @@ def get_current_price(symbol):
 # ===========================
 # إدارة التوصيات وإشعارات TP/SL
 # ===========================
-def update_recommendations_status():
+def get_open_trade_symbols():
+    session = SessionLocal()
+    try:
+        return [row[0] for row in session.query(Trade.symbol).filter(Trade.status=="open").distinct()]
+    finally:
+        session.close()
+
+def apply_price_updates(prices):
+    # تطبيق الأسعار (symbol -> price) على الصفقات المفتوحة وإرجاع الإشعارات لكل مستخدم
     session = SessionLocal()
+    notifications = {}  # chat_id -> قائمة الإشعارات لهذه الدورة
     try:
-        open_trades = session.query(Trade).filter(Trade.status=="open").all()
+        open_trades = session.query(Trade).options(joinedload(Trade.user)).filter(
+            Trade.status=="open",
+            Trade.symbol.in_(list(prices))
+        ).all()
         for trade in open_trades:
-            current_price = get_current_price(trade.symbol)
+            current_price = prices[trade.symbol]
             targets = trade_targets(trade.open_price)
+            events = notifications.setdefault(int(trade.user.telegram_id), [])
 
             # TP1
             if not trade.tp1_reached and current_price >= targets["take_profit_1"]:
                 trade.tp1_reached = 1
-                send_message(int(trade.user.telegram_id),
-                             f"✅ تم الوصول لهدف 4% لصفقة {trade.symbol} عند السعر {current_price}")
+                events.append(f"✅ تم الوصول لهدف 4% لصفقة {trade.symbol} عند السعر {current_price}")
             # TP2
             if current_price >= targets["take_profit_2"]:
                 trade.status = "closed"
                 trade.close_price = current_price
                 trade.close_time = datetime.utcnow()
                 trade.result = "win"
-                send_message(int(trade.user.telegram_id),
-                             f"🏆 تم إغلاق صفقة {trade.symbol} بالربح الكامل 10% عند السعر {current_price}")
+                events.append(f"🏆 تم إغلاق صفقة {trade.symbol} بالربح الكامل 10% عند السعر {current_price}")
             # Stop Loss
             if current_price <= targets["stop_loss"]:
                 trade.status = "closed"
                 trade.close_price = current_price
                 trade.close_time = datetime.utcnow()
                 trade.result = "loss"
-                send_message(int(trade.user.telegram_id),
-                             f"⚠️ تم إغلاق صفقة {trade.symbol} بالخسارة عند السعر {current_price}")
+                events.append(f"⚠️ تم إغلاق صفقة {trade.symbol} بالخسارة عند السعر {current_price}")
 
             session.add(trade)
         session.commit()
     finally:
         session.close()
+    return {chat_id: events for chat_id, events in notifications.items() if events}
+
+# ===========================
+# مراقبة متكيفة: تكرار الاستطلاع حسب قرب السعر من TP/SL وتقلب الرمز
+# ===========================
+DEFAULT_VOLATILITY = 0.04 / math.sqrt(86400)  # تقلب يومي 4% معبراً عنه لكل جذر ثانية
+PRICE_HISTORY_SIZE = 50
+
+_monitor_lock = threading.Lock()
+_price_history = {}       # symbol -> deque[(time, price)] من الاستطلاعات السابقة
+_last_polled_at = {}      # symbol -> وقت آخر استطلاع (time.monotonic)
+_desired_interval = {}    # symbol -> الفاصل المرغوب حسب القرب من العتبة والتقلب
+_threshold_distance = {}  # symbol -> أقرب مسافة نسبية لهدف أو وقف خسارة
+_budget_tokens = float(PRICE_REQUESTS_PER_MINUTE)
+_budget_updated_at = time.monotonic()
+
+def get_open_trade_levels(symbols):
+    # المستويات المتبقية (TP1 إن لم يتحقق، TP2، SL) للصفقات المفتوحة لكل رمز
+    session = SessionLocal()
+    try:
+        levels = {}
+        rows = session.query(Trade.symbol, Trade.open_price, Trade.tp1_reached).filter(
+            Trade.status=="open",
+            Trade.symbol.in_(symbols)
+        )
+        for symbol, open_price, tp1_reached in rows:
+            targets = trade_targets(open_price)
+            symbol_levels = levels.setdefault(symbol, [])
+            if not tp1_reached:
+                symbol_levels.append(targets["take_profit_1"])
+            symbol_levels.append(targets["take_profit_2"])
+            symbol_levels.append(targets["stop_loss"])
+        return levels
+    finally:
+        session.close()
+
+def symbol_volatility(symbol):
+    # الانحراف المعياري للعوائد اللوغاريتمية مقسومة على جذر الفاصل الزمني
+    history = list(_price_history.get(symbol, ()))
+    scaled = [
+        math.log(p1/p0) / math.sqrt(t1-t0)
+        for (t0, p0), (t1, p1) in zip(history, history[1:])
+        if t1 > t0
+    ]
+    if len(scaled) < 2:
+        return DEFAULT_VOLATILITY
+    mean = sum(scaled) / len(scaled)
+    variance = sum((x-mean)**2 for x in scaled) / (len(scaled)-1)
+    return max(math.sqrt(variance), DEFAULT_VOLATILITY / 10)
+
+def next_poll_interval(distance, volatility):
+    # الزمن المتوقع لقطع المسافة بحركة عشوائية ≈ (d/σ)²، ونستطلع عند ربعه
+    seconds = (distance / volatility) ** 2 / 4
+    return min(MAX_POLL_SECONDS, max(MIN_POLL_SECONDS, seconds))
+
+def effective_poll_intervals(desired):
+    # حجز استطلاع كل MAX_POLL_SECONDS لكل رمز أولاً، ثم توزيع الباقي من الميزانية على
+    # الرموز القريبة من العتبات بتمديد فواصلها بنفس النسبة حتى يتسع المجموع للميزانية.
+    # إن لم تكفِ الميزانية للحد الأدنى نفسه يُرفع الحد الأقصى للفاصل لجميع الرموز.
+    if not desired:
+        return {}
+    budget = PRICE_REQUESTS_PER_MINUTE / 60  # طلب/ثانية
+    floor_interval = len(desired) / budget
+    if floor_interval >= MAX_POLL_SECONDS:
+        return {symbol: floor_interval for symbol in desired}
+    intervals = {symbol: min(interval, MAX_POLL_SECONDS) for symbol, interval in desired.items()}
+    scale = 1.0
+    for _ in range(len(intervals)):
+        free = [s for s, interval in intervals.items() if interval * scale < MAX_POLL_SECONDS]
+        if not free:
+            break
+        spare = budget - (len(intervals) - len(free)) / MAX_POLL_SECONDS
+        new_scale = max(1.0, sum(1 / intervals[s] for s in free) / spare)
+        if abs(new_scale - scale) < 1e-9:
+            break
+        scale = new_scale
+    return {symbol: min(MAX_POLL_SECONDS, interval * scale) for symbol, interval in intervals.items()}
+
+def plan_price_polls():
+    # اختيار الرموز المستحقة ضمن الميزانية المشتركة: الرموز الجديدة أولاً ثم الأقدم موعداً
+    # (EDF) حتى لا يستحوذ الرموز القريبة من العتبة على الميزانية، والأقرب للعتبة عند التساوي
+    global _budget_tokens, _budget_updated_at
+    symbols = set(get_open_trade_symbols())
+    now = time.monotonic()
+    with _monitor_lock:
+        for symbol in set(_last_polled_at) | set(_desired_interval) | set(_price_history):
+            if symbol not in symbols:
+                _last_polled_at.pop(symbol, None)
+                _desired_interval.pop(symbol, None)
+                _threshold_distance.pop(symbol, None)
+                _price_history.pop(symbol, None)
+        _budget_tokens = min(
+            float(PRICE_REQUESTS_PER_MINUTE),
+            _budget_tokens + (now - _budget_updated_at) * PRICE_REQUESTS_PER_MINUTE / 60
+        )
+        _budget_updated_at = now
+        intervals = effective_poll_intervals(
+            {symbol: _desired_interval.get(symbol, MIN_POLL_SECONDS) for symbol in symbols}
+        )
+        deadlines = {
+            symbol: _last_polled_at[symbol] + intervals[symbol] if symbol in _last_polled_at else -math.inf
+            for symbol in symbols
+        }
+        due = sorted(
+            (s for s in symbols if deadlines[s] <= now),
+            key=lambda s: (deadlines[s], _threshold_distance.get(s, 0), s)
+        )
+        selected = due[:int(_budget_tokens)]
+        _budget_tokens -= len(selected)
+        for symbol in selected:
+            _last_polled_at[symbol] = now
+        return selected
+
+def record_price_polls(prices):
+    # تطبيق الأسعار الجديدة وتحديث الفاصل المرغوب لكل رمز، وإرجاع الإشعارات لكل مستخدم
+    now = time.monotonic()
+    # فشل جلب السعر (0) لا يُعامل كسعر حقيقي حتى لا يُغلق الصفقات بوقف الخسارة
+    valid = {symbol: price for symbol, price in prices.items() if price and price > 0}
+    notifications = apply_price_updates(valid) if valid else {}
+    levels = get_open_trade_levels(list(valid)) if valid else {}
+    with _monitor_lock:
+        for symbol in prices:
+            if symbol not in valid:
+                _desired_interval[symbol] = MIN_POLL_SECONDS  # إعادة المحاولة قريباً
+        for symbol, price in valid.items():
+            _price_history.setdefault(symbol, deque(maxlen=PRICE_HISTORY_SIZE)).append((now, price))
+            if symbol not in levels:
+                _last_polled_at.pop(symbol, None)
+                _desired_interval.pop(symbol, None)
+                _threshold_distance.pop(symbol, None)
+                continue
+            distance = min(abs(level-price) / price for level in levels[symbol])
+            _threshold_distance[symbol] = distance
+            _desired_interval[symbol] = next_poll_interval(distance, symbol_volatility(symbol))
+    return notifications
+
+def adaptive_monitor_tick():
+    symbols = plan_price_polls()
+    if not symbols:
+        return
+    prices = {symbol: get_current_price(symbol) for symbol in symbols}
+    for chat_id, events in record_price_polls(prices).items():
+        send_digest(chat_id, events)
 
 # ===========================
 # التقارير اليومية
@@ -281,7 +507,8 @@ def get_trade_stats():
     finally:
         session.close()
 
-def send_daily_report():
+def build_daily_report():
+    # إرجاع (قائمة chat_id للمشتركين النشطين, نص التقرير) دون إرسال
     session = SessionLocal()
     try:
         active_subs = session.query(Subscription).filter(Subscription.status=="active").all()
@@ -293,44 +520,74 @@ def send_daily_report():
             f"📈 نسبة الفوز: {win_rate:.2f}%\n"
             f"📉 نسبة الخسارة: {loss_rate:.2f}%"
         )
-        for sub in active_subs:
-            send_message(int(sub.user.telegram_id), report_text)
+        return [int(sub.user.telegram_id) for sub in active_subs], report_text
     finally:
         session.close()
 
+def send_daily_report():
+    chat_ids, report_text = build_daily_report()
+    for chat_id in chat_ids:
+        send_message(chat_id, report_text)
+
 # ===========================
 # جدولة المهام
 # ===========================
 scheduler = BackgroundScheduler()
-scheduler.add_job(func=update_recommendations_status, trigger="interval", minutes=5)
-scheduler.add_job(func=send_daily_report, trigger="cron", hour=4, minute=0)  # 7 صباحاً السعودية = 4 UTC
-scheduler.start()
-atexit.register(lambda: scheduler.shutdown())
+scheduler.add_job(func=profiled("adaptive_monitor_tick")(adaptive_monitor_tick), trigger="interval", seconds=ADAPTIVE_TICK_SECONDS)
+scheduler.add_job(func=profiled("send_daily_report")(send_daily_report), trigger="cron", hour=4, minute=0)  # 7 صباحاً السعودية = 4 UTC
+# وضع asyncio (market_signals_async.py) يعطل هذا المجدول ويشغل المهام من حلقة الأحداث
+if os.getenv("BACKGROUND_SCHEDULER", "1") == "1":
+    scheduler.start()
+    atexit.register(lambda: scheduler.shutdown())
 
 # ===========================
 # Webhook تليجرام
 # ===========================
-@app.route(WEBHOOK_ROUTE, methods=["POST"])
-def telegram_webhook():
-    expire_subscriptions()
-    update_recommendations_status()
-    update = request.get_json()
+ADVICE_SYMBOLS = ("BTC-USDT","ETH-USDT","XRP-USDT")
+
+def invoice_reply_text(invoice_url):
+    if invoice_url:
+        return f"يرجى دفع الاشتراك عبر الرابط:\n{invoice_url}"
+    return "حدث خطأ أثناء إنشاء رابط الدفع."
+
+def advice_reply_text(signal_symbols):
+    messages = [f"📈 توصية شراء لـ {sym}" for sym in signal_symbols]
+    return "\n\n".join(messages) if messages else "📊 لا توجد توصيات حالياً."
+
+def resolve_reply(reply_text):
+    # الردود المؤجلة تحتاج طلبات خارجية تُنفذ بعد إغلاق جلسة قاعدة البيانات:
+    # ("invoice", telegram_id, amount) أو ("advice", symbols)
+    if isinstance(reply_text, str):
+        return reply_text
+    kind, *args = reply_text
+    if kind == "invoice":
+        return invoice_reply_text(create_nowpayments_invoice(*args))
+    return advice_reply_text([sym for sym in args[0] if check_signal(sym)])
+
+def handle_telegram_update(update):
+    # معالجة تحديث تليجرام وإرجاع الردود كقائمة (chat_id, text) دون إرسالها،
+    # حيث text نص جاهز أو رد مؤجل يُحل عبر resolve_reply
+    replies = []
     if not update or "message" not in update:
-        return "ok"
+        return replies
     message = update["message"]
     chat_id = message["chat"]["id"]
     text = message.get("text","")
     from_user = message.get("from",{})
     telegram_id = str(from_user.get("id"))
+
+    def reply(reply_text):
+        replies.append((chat_id, reply_text))
+
     session = SessionLocal()
     try:
         user = get_user(session, telegram_id, True, from_user)
         active_subs = get_active_subscriptions(session, user.id)
         # الأوامر
         if text=="/start":
-            send_message(chat_id, f"مرحبًا {user.first_name or ''} 👋\nالبوت يعمل بنجاح.\nاستخدم /help لمعرفة الأوامر.")
+            reply(f"مرحبًا {user.first_name or ''} 👋\nالبوت يعمل بنجاح.\nاستخدم /help لمعرفة الأوامر.")
         elif text=="/help":
-            send_message(chat_id,
+            reply(
                 "/subscribe 1 - الاشتراك في الاستراتيجية 1 (40$)\n"
                 "/subscribe 2 - الاشتراك في الاستراتيجية 2 (70$)\n"
                 "/status - حالة الاشتراكات\n"
@@ -340,69 +597,65 @@ def telegram_webhook():
         elif text.startswith("/subscribe"):
             parts = text.split()
             if len(parts)<2 or parts[1] not in ["1","2"]:
-                send_message(chat_id, "يرجى اختيار خطة صحيحة: اكتب /subscribe 1 أو /subscribe 2")
+                reply("يرجى اختيار خطة صحيحة: اكتب /subscribe 1 أو /subscribe 2")
             else:
                 choice = parts[1]
                 strategy = "strategy_advanced"
                 amount = 40 if choice=="1" else 70
                 existing_sub = get_active_subscription_by_strategy(session, user.id, strategy)
                 if existing_sub:
-                    send_message(chat_id, f"🚫 أنت مشترك حالياً حتى {existing_sub.end_date.strftime('%Y-%m-%d')}")
+                    reply(f"🚫 أنت مشترك حالياً حتى {existing_sub.end_date.strftime('%Y-%m-%d')}")
                 else:
-                    invoice_url = create_nowpayments_invoice(telegram_id, amount)
-                    if invoice_url:
-                        send_message(chat_id, f"يرجى دفع الاشتراك عبر الرابط:\n{invoice_url}")
-                    else:
-                        send_message(chat_id, "حدث خطأ أثناء إنشاء رابط الدفع.")
+                    reply(("invoice", telegram_id, amount))
         elif text=="/status":
             if not active_subs:
-                send_message(chat_id, "🚫 لا يوجد لديك اشتراكات نشطة.")
+                reply("🚫 لا يوجد لديك اشتراكات نشطة.")
             else:
                 msgs=[]
                 for sub in active_subs:
                     msgs.append(f"استراتيجية {sub.strategy}:\nمن: {sub.start_date.strftime('%Y-%m-%d')}\nإلى: {sub.end_date.strftime('%Y-%m-%d')}\nالحالة: {sub.status}")
-                send_message(chat_id, "\n\n".join(msgs))
+                reply("\n\n".join(msgs))
         elif text.startswith("/cancel"):
             parts = text.split()
             if len(parts)<2 or parts[1] not in ["1","2"]:
-                send_message(chat_id, "يرجى تحديد الاشتراك للإلغاء: اكتب /cancel 1 أو /cancel 2")
+                reply("يرجى تحديد الاشتراك للإلغاء: اكتب /cancel 1 أو /cancel 2")
             else:
                 existing_sub = get_active_subscription_by_strategy(session, user.id, "strategy_advanced")
                 if not existing_sub:
-                    send_message(chat_id, "ليس لديك اشتراك نشط للإلغاء.")
+                    reply("ليس لديك اشتراك نشط للإلغاء.")
                 else:
                     existing_sub.status="expired"
                     session.add(existing_sub)
                     session.commit()
-                    send_message(chat_id, "تم إلغاء الاشتراك. شكرًا لك.")
+                    reply("تم إلغاء الاشتراك. شكرًا لك.")
         elif text=="/advice":
             if not active_subs:
-                send_message(chat_id,"🚫 يرجى الاشتراك أولاً.")
+                reply("🚫 يرجى الاشتراك أولاً.")
             else:
-                symbols = ["BTC-USDT","ETH-USDT","XRP-USDT"]
-                messages=[]
-                for sym in symbols:
-                    if check_signal(sym):
-                        messages.append(f"📈 توصية شراء لـ {sym}")
-                send_message(chat_id,"\n\n".join(messages) if messages else "📊 لا توجد توصيات حالياً.")
+                reply(("advice", ADVICE_SYMBOLS))
         else:
             if not active_subs:
-                send_message(chat_id,"🚫 يرجى الاشتراك أولاً.\nاستخدم /subscribe للاطلاع على الخطط.")
+                reply("🚫 يرجى الاشتراك أولاً.\nاستخدم /subscribe للاطلاع على الخطط.")
             else:
-                send_message(chat_id,"❓ أمر غير معروف، استخدم /help للمساعدة.")
+                reply("❓ أمر غير معروف، استخدم /help للمساعدة.")
     finally:
         session.close()
+    return replies
+
+@app.route(WEBHOOK_ROUTE, methods=["POST"])
+@profiled("telegram_webhook")
+def telegram_webhook():
+    expire_subscriptions()
+    adaptive_monitor_tick()
+    for chat_id, text in handle_telegram_update(request.get_json()):
+        send_message(chat_id, resolve_reply(text))
     return "ok"
 
 # ===========================
 # Webhook NowPayments
 # ===========================
-@app.route(NOWPAYMENTS_ROUTE, methods=["POST"])
-def nowpayments_webhook():
-    signature = request.headers.get("x-nowpayments-sig")
-    if signature != NOWPAYMENTS_IPN_SECRET:
-        return "Unauthorized", 401
-    data = request.get_json()
+def process_nowpayments_ipn(data):
+    # معالجة إشعار الدفع وإرجاع (الرد, رمز الحالة, رسالة التفعيل أو None) دون إرسال الرسالة
     payment_status = data.get("payment_status")
     payment_id = data.get("payment_id")
     order_id = data.get("order_id")
@@ -412,6 +665,14 @@ def nowpayments_webhook():
     if payment_status=="finished":
         session = SessionLocal()
         try:
+            # التحقق من التكرار وتسجيل الدفعة في نفس المعاملة (الفهرس الفريد يمنع الإدخال المزدوج)
+            if payment_id is not None:
+                session.add(ProcessedPayment(payment_id=str(payment_id)))
+                try:
+                    session.flush()
+                except IntegrityError:
+                    session.rollback()
+                    return {"message":"Payment already processed"}, 200, None
             telegram_id=None
             if custom_data:
                 try:
@@ -420,14 +681,15 @@ def nowpayments_webhook():
                 except:
                     telegram_id=str(custom_data)
             if not telegram_id:
-                return jsonify({"error":"telegram_id غير موجود"}),400
+                return {"error":"telegram_id غير موجود"}, 400, None
             user = get_user(session, telegram_id, False)
             if not user:
-                return jsonify({"error":"User not found"}),404
+                return {"error":"User not found"}, 404, None
             strategy="strategy_advanced"
             existing_sub = get_active_subscription_by_strategy(session, user.id, strategy)
             if existing_sub:
-                return jsonify({"message":"Subscription already active"}),200
+                session.commit()
+                return {"message":"Subscription already active"}, 200, None
             start_date=datetime.utcnow()
             end_date=start_date+timedelta(days=30)
             new_sub=Subscription(
@@ -442,11 +704,118 @@ def nowpayments_webhook():
             )
             session.add(new_sub)
             session.commit()
-            send_message(int(user.telegram_id),
-                         f"✅ تم تفعيل اشتراكك حتى {end_date.strftime('%Y-%m-%d')}")
+            return "ok", 200, (int(user.telegram_id), f"✅ تم تفعيل اشتراكك حتى {end_date.strftime('%Y-%m-%d')}")
         finally:
             session.close()
-    return "ok"
+    return "ok", 200, None
+
+@app.route(NOWPAYMENTS_ROUTE, methods=["POST"])
+@profiled("nowpayments_webhook")
+def nowpayments_webhook():
+    signature = request.headers.get("x-nowpayments-sig")
+    if signature != NOWPAYMENTS_IPN_SECRET:
+        return "Unauthorized", 401
+    response, status, notification = process_nowpayments_ipn(request.get_json())
+    if notification:
+        send_message(*notification)
+    if isinstance(response, dict):
+        return jsonify(response), status
+    return response, status
+
+# ===========================
+# تصدير السجل (للمشرف) - بث تدريجي دون تحميل كل الصفوف في الذاكرة
+# ===========================
+EXPORT_TABLES = {
+    # النوع -> (الجدول, عمود التاريخ للفلترة, الفلاتر المسموحة)
+    "trades": (Trade.__table__, "open_time", ("strategy", "symbol")),
+    "subscriptions": (Subscription.__table__, "start_date", ("strategy",)),
+}
+
+def _export_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+def parse_export_bound(value, is_end=False):
+    # تاريخ بدون وقت (YYYY-MM-DD) كحد نهائي يشمل ذلك اليوم كاملاً
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value)
+    if is_end and len(value) == 10:
+        parsed += timedelta(days=1)
+    return parsed
+
+def iter_export_rows(kind, start=None, end=None, filters=None):
+    # صفحات بمفتاح id (WHERE id > last_id LIMIT n)، كل صفحة في اتصال قصير،
+    # حتى لا يبقى قفل قراءة SQLite مفتوحاً طوال التنزيل ويحجب عمليات الكتابة
+    table, date_column, _ = EXPORT_TABLES[kind]
+    stmt = select(table).order_by(table.c.id).limit(EXPORT_BATCH_SIZE)
+    if start:
+        stmt = stmt.where(table.c[date_column] >= start)
+    if end:
+        stmt = stmt.where(table.c[date_column] < end)
+    for name, value in (filters or {}).items():
+        stmt = stmt.where(table.c[name] == value)
+    last_id = None
+    while True:
+        page = stmt if last_id is None else stmt.where(table.c.id > last_id)
+        with engine.connect() as conn:
+            rows = conn.execute(page).all()
+        if not rows:
+            return
+        last_id = rows[-1].id
+        yield [{key: _export_value(value) for key, value in row._mapping.items()} for row in rows]
+        if len(rows) < EXPORT_BATCH_SIZE:
+            return
+
+def iter_export_chunks(kind, fmt, start=None, end=None, filters=None):
+    columns = [c.name for c in EXPORT_TABLES[kind][0].columns]
+    if fmt == "csv":
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=columns)
+        writer.writeheader()
+        for batch in iter_export_rows(kind, start, end, filters):
+            writer.writerows(batch)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+    else:
+        for batch in iter_export_rows(kind, start, end, filters):
+            yield "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in batch)
+
+def gzip_stream(chunks):
+    compressor = zlib.compressobj(wbits=31)  # 31 = تنسيق gzip
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
+
+@app.route(EXPORT_ROUTE, methods=["GET"])
+def export_history(kind):
+    provided_key = request.headers.get("x-admin-key", "")
+    if not ADMIN_API_KEY or not hmac.compare_digest(provided_key.encode(), ADMIN_API_KEY.encode()):
+        return "Unauthorized", 401
+    if kind not in EXPORT_TABLES:
+        return jsonify({"error":"نوع تصدير غير معروف"}),404
+    fmt = request.args.get("format", "csv")
+    if fmt not in ("csv", "ndjson"):
+        return jsonify({"error":"format يجب أن يكون csv أو ndjson"}),400
+    try:
+        start = parse_export_bound(request.args.get("start"))
+        end = parse_export_bound(request.args.get("end"), is_end=True)
+    except ValueError:
+        return jsonify({"error":"تاريخ غير صالح، استخدم صيغة ISO مثل 2024-01-31 (end بدون وقت يشمل اليوم كاملاً)"}),400
+    filters = {name: request.args[name] for name in EXPORT_TABLES[kind][2] if request.args.get(name)}
+
+    chunks = iter_export_chunks(kind, fmt, start, end, filters)
+    mimetype = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    filename = f"{kind}.{fmt}"
+    if request.args.get("gzip") == "1":
+        chunks = gzip_stream(chunks)
+        mimetype = "application/gzip"
+        filename += ".gz"
+    headers = {"Content-Disposition": f"attachment; filename={filename}"}
+    return Response(stream_with_context(chunks), mimetype=mimetype, headers=headers)
 
 # ===========================
 # Flask Main
@@ -0,0 +1,103 @@
+# query_profiler.py
+# عدّ وتوقيت استعلامات SQLAlchemy لكل طلب Webhook أو مهمة مجدولة،
+# مع التنبيه على الاستعلامات المتكررة (نمط N+1) وميزانيات عدد الاستعلامات للاختبارات.
+import os
+import time
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+from sqlalchemy import event
+
+QUERY_PROFILING = os.getenv("QUERY_PROFILING") == "1"
+N_PLUS_ONE_THRESHOLD = int(os.getenv("N_PLUS_ONE_THRESHOLD", 3))
+
+_state = threading.local()
+
+class QueryStats:
+    def __init__(self, label):
+        self.label = label
+        self.count = 0
+        self.total_time = 0.0
+        self.statements = Counter()
+
+    def repeated_statements(self, threshold=N_PLUS_ONE_THRESHOLD):
+        return {stmt: n for stmt, n in self.statements.items() if n >= threshold}
+
+def _active_stats():
+    return getattr(_state, "stack", None)
+
+def _record(context, statement):
+    # وقت البدء محفوظ على سياق التنفيذ الخاص بالاستعلام نفسه، فلا يبقى شيء على الاتصال
+    start = getattr(context, "_query_start_time", None)
+    stack = _active_stats()
+    if start is None or not stack:
+        return
+    del context._query_start_time
+    elapsed = time.perf_counter() - start
+    # الاستعلامات المتداخلة تُحسب في كل النطاقات المفتوحة (الطلب والمهمة الداخلية)
+    for stats in stack:
+        stats.count += 1
+        stats.total_time += elapsed
+        stats.statements[statement] += 1
+
+def install_query_profiler(engine):
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if _active_stats() and context is not None:
+            context._query_start_time = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        _record(context, statement)
+
+    @event.listens_for(engine, "handle_error")
+    def _handle_error(exception_context):
+        # after_cursor_execute لا يُستدعى للاستعلام الفاشل (مثل IntegrityError)
+        _record(exception_context.execution_context, exception_context.statement)
+
+@contextmanager
+def collect_queries(stats):
+    # ربط QueryStats موجود بهذا الخيط (مثلاً خيوط Executor لطلب asyncio واحد) دون تقرير
+    if _active_stats() is None:
+        _state.stack = []
+    _state.stack.append(stats)
+    try:
+        yield stats
+    finally:
+        _state.stack.remove(stats)
+
+def report_query_stats(stats):
+    for stmt, n in stats.repeated_statements().items():
+        print(f"⚠️ نمط N+1 محتمل في {stats.label}: الاستعلام تكرر {n} مرات: {stmt}")
+    if QUERY_PROFILING:
+        print(f"📊 {stats.label}: {stats.count} استعلام في {stats.total_time*1000:.1f}ms")
+
+@contextmanager
+def profile_queries(label):
+    stats = QueryStats(label)
+    try:
+        with collect_queries(stats):
+            yield stats
+    finally:
+        report_query_stats(stats)
+
+def profiled(label):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with profile_queries(label):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+@contextmanager
+def assert_max_queries(limit, label="query budget"):
+    # للاختبارات: with assert_max_queries(2): handle_telegram_update(update)
+    with profile_queries(label) as stats:
+        yield stats
+    if stats.count > limit:
+        raise AssertionError(
+            f"{label}: {stats.count} استعلام يتجاوز الميزانية ({limit})\n"
+            + "\n".join(f"{n}x {stmt}" for stmt, n in stats.statements.most_common())
+        )
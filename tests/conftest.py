@@ -0,0 +1,74 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# يجب ضبط البيئة قبل استيراد market_signals_bot (قاعدة البيانات والمجدول تُنشأ عند الاستيراد)
+_db_dir = tempfile.mkdtemp(prefix="market_signals_test_")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_db_dir, 'test.db')}"
+os.environ["BACKGROUND_SCHEDULER"] = "0"
+os.environ["NOWPAYMENTS_IPN_SECRET"] = "test-ipn-secret"
+os.environ["ADMIN_API_KEY"] = "test-admin-key"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import market_signals_bot as bot
+
+
+@pytest.fixture(autouse=True)
+def clean_db():
+    with bot.engine.begin() as conn:
+        for table in reversed(bot.Base.metadata.sorted_tables):
+            conn.execute(table.delete())
+    with bot._monitor_lock:
+        bot._price_history.clear()
+        bot._last_polled_at.clear()
+        bot._desired_interval.clear()
+        bot._threshold_distance.clear()
+        bot._budget_tokens = float(bot.PRICE_REQUESTS_PER_MINUTE)
+        bot._budget_updated_at = bot.time.monotonic()
+    yield
+
+
+@pytest.fixture
+def sent_messages(monkeypatch):
+    sent = []
+    monkeypatch.setattr(bot, "send_message", lambda chat_id, text: sent.append((chat_id, text)))
+    return sent
+
+
+def telegram_update(telegram_id, text):
+    return {"message": {"chat": {"id": int(telegram_id)}, "text": text, "from": {"id": int(telegram_id)}}}
+
+
+def add_user(telegram_id="100", with_subscription=False):
+    from datetime import datetime, timedelta
+    session = bot.SessionLocal()
+    try:
+        user = bot.User(telegram_id=str(telegram_id), first_name="Test")
+        session.add(user)
+        session.flush()
+        if with_subscription:
+            now = datetime.utcnow()
+            session.add(bot.Subscription(
+                user_id=user.id,
+                strategy="strategy_advanced",
+                start_date=now - timedelta(days=1),
+                end_date=now + timedelta(days=29),
+                status="active",
+            ))
+        session.commit()
+        return user.id
+    finally:
+        session.close()
+
+
+def add_open_trade(user_id, symbol="BTC-USDT", open_price=100.0):
+    from datetime import datetime
+    session = bot.SessionLocal()
+    try:
+        session.add(bot.Trade(user_id=user_id, strategy="strategy_advanced", symbol=symbol,
+                              open_time=datetime.utcnow(), open_price=open_price, status="open"))
+        session.commit()
+    finally:
+        session.close()
@@ -0,0 +1,109 @@
+from types import SimpleNamespace
+
+import pytest
+
+import market_signals_bot as bot
+from conftest import add_open_trade, add_user
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = SimpleNamespace(now=1000.0)
+    fake.monotonic = lambda: fake.now
+    monkeypatch.setattr(bot, "time", fake)
+    bot._budget_updated_at = fake.now
+    return fake
+
+
+def test_next_poll_interval_is_clamped():
+    vol = bot.DEFAULT_VOLATILITY
+    assert bot.next_poll_interval(0.0, vol) == bot.MIN_POLL_SECONDS
+    assert bot.next_poll_interval(0.5, vol) == bot.MAX_POLL_SECONDS
+    middle = bot.next_poll_interval(0.002, vol)
+    assert bot.MIN_POLL_SECONDS < middle < bot.MAX_POLL_SECONDS
+
+
+def test_symbol_volatility_defaults_then_follows_samples():
+    assert bot.symbol_volatility("BTC-USDT") == bot.DEFAULT_VOLATILITY
+    bot._price_history["BTC-USDT"] = [(0, 100.0), (10, 101.0), (20, 99.0), (30, 101.5)]
+    assert bot.symbol_volatility("BTC-USDT") > bot.DEFAULT_VOLATILITY
+    bot._price_history["ETH-USDT"] = [(0, 100.0), (10, 100.0), (20, 100.0)]
+    assert bot.symbol_volatility("ETH-USDT") == bot.DEFAULT_VOLATILITY / 10
+
+
+def test_failed_fetch_keeps_trade_open_and_retries_soon(clock):
+    add_open_trade(add_user("100"), "BTC-USDT")
+    assert bot.plan_price_polls() == ["BTC-USDT"]
+    assert bot.record_price_polls({"BTC-USDT": 0}) == {}
+
+    session = bot.SessionLocal()
+    try:
+        assert session.query(bot.Trade).one().status == "open"
+    finally:
+        session.close()
+    clock.now += bot.MIN_POLL_SECONDS - 1
+    assert bot.plan_price_polls() == []
+    clock.now += 1
+    assert bot.plan_price_polls() == ["BTC-USDT"]
+
+
+def test_token_bucket_is_shared_between_callers(clock):
+    user_id = add_user("100")
+    for i in range(bot.PRICE_REQUESTS_PER_MINUTE + 10):
+        add_open_trade(user_id, f"C{i}-USDT")
+
+    first = bot.plan_price_polls()
+    assert len(first) == bot.PRICE_REQUESTS_PER_MINUTE
+    assert bot.plan_price_polls() == []  # مستدعٍ آخر (Webhook مثلاً) لا يجد رصيداً
+    clock.now += 60 / bot.PRICE_REQUESTS_PER_MINUTE
+    second = bot.plan_price_polls()
+    assert len(second) == 1 and second[0] not in first
+
+
+def test_budget_shortfall_raises_every_interval():
+    symbols = {f"S{i}": bot.MIN_POLL_SECONDS for i in range(200)}
+    intervals = bot.effective_poll_intervals(symbols)
+    expected = 200 / (bot.PRICE_REQUESTS_PER_MINUTE / 60)
+    assert set(intervals.values()) == {expected}
+
+
+def test_near_threshold_symbols_do_not_starve_others(monkeypatch, clock):
+    # 10 رموز على بعد 0.1% من TP1 ورمز بعيد، ساعة كاملة بالإعدادات الافتراضية؛
+    # الرموز القريبة متطابقة فيجب أن تتقاسم الميزانية بالتساوي
+    monkeypatch.setattr(bot, "symbol_volatility", lambda symbol: bot.DEFAULT_VOLATILITY)
+    user_id = add_user("100")
+    near = [f"N{i}-USDT" for i in range(10)]
+    for symbol in near:
+        add_open_trade(user_id, symbol, open_price=100.0)
+    add_open_trade(user_id, "FAR-USDT", open_price=100.0)
+    near_price = 100.0 * 1.04 * (1 - 0.001)
+
+    polls = {symbol: [] for symbol in near + ["FAR-USDT"]}
+    end = clock.now + 3600
+    while clock.now < end:
+        symbols = bot.plan_price_polls()
+        prices = {}
+        for symbol in symbols:
+            polls[symbol].append(clock.now)
+            base = 100.0 if symbol == "FAR-USDT" else near_price
+            prices[symbol] = base
+        if symbols:
+            bot.record_price_polls(prices)
+        clock.now += bot.ADAPTIVE_TICK_SECONDS
+
+    total = sum(len(times) for times in polls.values())
+    assert total <= bot.PRICE_REQUESTS_PER_MINUTE * 61
+    for symbol, times in polls.items():
+        gaps = [b - a for a, b in zip(times, times[1:])] + [end - times[-1]]
+        assert max(gaps) <= bot.MAX_POLL_SECONDS + bot.ADAPTIVE_TICK_SECONDS, symbol
+    near_counts = [len(polls[symbol]) for symbol in near]
+    assert min(near_counts) >= 0.8 * max(near_counts)
+    assert min(near_counts) > 3 * len(polls["FAR-USDT"])
+
+
+def test_open_symbol_lookup_uses_status_index():
+    with bot.engine.connect() as conn:
+        plan = conn.exec_driver_sql(
+            "EXPLAIN QUERY PLAN SELECT DISTINCT symbol FROM trades WHERE status = 'open'"
+        ).all()
+    assert any("ix_trades_status_symbol" in str(row) for row in plan)
@@ -0,0 +1,120 @@
+import asyncio
+import json
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+import market_signals_async as ma
+import market_signals_bot as bot
+from conftest import add_open_trade, add_user, telegram_update
+
+
+@pytest.fixture
+def async_sent(monkeypatch):
+    sent = []
+
+    async def fake_send(http, chat_id, text, retry=True):
+        sent.append((chat_id, text))
+
+    monkeypatch.setattr(ma, "send_message_async", fake_send)
+    return sent
+
+
+def run_with_client(scenario):
+    async def main():
+        async with TestClient(TestServer(ma.create_app())) as client:
+            return await scenario(client)
+    return asyncio.run(main())
+
+
+def test_status_through_async_webhook(async_sent):
+    add_user("100", with_subscription=True)
+
+    async def scenario(client):
+        resp = await client.post(bot.WEBHOOK_ROUTE, json=telegram_update("100", "/status"))
+        assert resp.status == 200
+
+    run_with_client(scenario)
+    assert len(async_sent) == 1
+    assert async_sent[0][0] == 100 and "strategy_advanced" in async_sent[0][1]
+
+
+def test_duplicate_ipn_activates_once_and_bad_body_is_400(async_sent):
+    add_user("100")
+    ipn = {
+        "payment_status": "finished",
+        "payment_id": "async-1",
+        "order_description": json.dumps({"telegram_id": "100"}),
+    }
+    headers = {"x-nowpayments-sig": bot.NOWPAYMENTS_IPN_SECRET}
+
+    async def scenario(client):
+        statuses = []
+        for _ in range(3):
+            resp = await client.post(bot.NOWPAYMENTS_ROUTE, json=ipn, headers=headers)
+            statuses.append(resp.status)
+        bad = await client.post(bot.NOWPAYMENTS_ROUTE, data="{not json", headers=headers)
+        return statuses, bad.status
+
+    statuses, bad_status = run_with_client(scenario)
+    assert statuses == [200, 200, 200]
+    assert bad_status == 400
+    assert len(async_sent) == 1
+    session = bot.SessionLocal()
+    try:
+        assert session.query(bot.Subscription).count() == 1
+    finally:
+        session.close()
+
+
+def test_concurrent_updates_share_one_monitor_pass(monkeypatch, async_sent):
+    add_open_trade(add_user("100"), "BTC-USDT")
+    plans = []
+    original_plan = ma.plan_price_polls
+
+    def counting_plan():
+        plans.append(1)
+        return original_plan()
+
+    async def slow_price(http, symbol):
+        await asyncio.sleep(0.05)
+        return 100.0
+
+    monkeypatch.setattr(ma, "plan_price_polls", counting_plan)
+    monkeypatch.setattr(ma, "get_current_price_async", slow_price)
+
+    async def scenario(client):
+        updates = [client.post(bot.WEBHOOK_ROUTE, json={}) for _ in range(5)]
+        return [resp.status for resp in await asyncio.gather(*updates)]
+
+    assert run_with_client(scenario) == [200] * 5
+    assert len(plans) == 1
+
+
+def test_send_retries_once_after_429(monkeypatch):
+    calls = []
+
+    class FakeResponse:
+        def __init__(self, status, body):
+            self.status = status
+            self._body = body
+
+        async def read(self):
+            return self._body
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc):
+            return False
+
+    class FakeHttp:
+        def post(self, url, json):
+            calls.append(json)
+            if len(calls) == 1:
+                return FakeResponse(429, b'{"ok":false,"parameters":{"retry_after":0}}')
+            return FakeResponse(200, b'{"ok":true}')
+
+    monkeypatch.setattr(ma, "_next_send_slot", 0.0)
+    asyncio.run(ma.send_message_async(FakeHttp(), 100, "hi"))
+    assert len(calls) == 2
@@ -0,0 +1,79 @@
+import csv
+import gzip
+import io
+import json
+from datetime import datetime
+
+import market_signals_bot as bot
+from conftest import add_user
+
+
+def add_trades(user_id, count, open_time=datetime(2024, 1, 15), symbol="BTC-USDT"):
+    session = bot.SessionLocal()
+    try:
+        session.add_all([
+            bot.Trade(user_id=user_id, strategy="strategy_advanced", symbol=symbol,
+                      open_time=open_time, open_price=100.0, status="closed")
+            for _ in range(count)
+        ])
+        session.commit()
+    finally:
+        session.close()
+
+
+def test_write_succeeds_while_export_is_paused(monkeypatch):
+    monkeypatch.setattr(bot, "EXPORT_BATCH_SIZE", 10)
+    add_trades(add_user("100"), 45)
+    add_user("200")
+
+    chunks = bot.iter_export_chunks("trades", "csv")
+    first = next(chunks)  # التنزيل متوقف بعد الدفعة الأولى
+
+    response, status, notification = bot.process_nowpayments_ipn({
+        "payment_status": "finished",
+        "payment_id": "during-export",
+        "order_description": json.dumps({"telegram_id": "200"}),
+    })
+    assert status == 200 and notification is not None
+
+    rows = list(csv.DictReader(io.StringIO(first + "".join(chunks))))
+    assert len(rows) == 45
+    assert len({row["id"] for row in rows}) == 45
+
+
+def test_date_only_end_includes_whole_day():
+    user_id = add_user("100")
+    add_trades(user_id, 2, open_time=datetime(2024, 1, 31, 18, 30))
+    add_trades(user_id, 1, open_time=datetime(2024, 2, 1, 0, 0))
+
+    client = bot.app.test_client()
+    resp = client.get(
+        "/market-signals-bot/admin/export/trades?format=ndjson&start=2024-01-01&end=2024-01-31",
+        headers={"x-admin-key": bot.ADMIN_API_KEY},
+    )
+    assert resp.status_code == 200
+    rows = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+    assert len(rows) == 2
+    assert all(row["open_time"].startswith("2024-01-31") for row in rows)
+
+
+def test_export_requires_admin_key():
+    client = bot.app.test_client()
+    url = "/market-signals-bot/admin/export/trades"
+    assert client.get(url).status_code == 401
+    assert client.get(url, headers={"x-admin-key": "wrong"}).status_code == 401
+
+
+def test_gzip_export_is_valid_gzip(monkeypatch):
+    monkeypatch.setattr(bot, "EXPORT_BATCH_SIZE", 7)
+    add_trades(add_user("100"), 30)
+
+    client = bot.app.test_client()
+    resp = client.get(
+        "/market-signals-bot/admin/export/trades?format=csv&gzip=1",
+        headers={"x-admin-key": bot.ADMIN_API_KEY},
+    )
+    assert resp.status_code == 200
+    assert resp.mimetype == "application/gzip"
+    rows = list(csv.DictReader(io.StringIO(gzip.decompress(resp.get_data()).decode("utf-8"))))
+    assert len(rows) == 30
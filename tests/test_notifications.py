@@ -0,0 +1,49 @@
+import market_signals_bot as bot
+from conftest import add_open_trade, add_user
+
+
+def test_split_digest_joins_lines_into_one_message():
+    assert bot.split_digest(["a", "b", "c"]) == ["a\n\nb\n\nc"]
+
+
+def test_split_digest_splits_only_past_length_limit():
+    limit = bot.TELEGRAM_MAX_MESSAGE_LENGTH
+    # "a"*(limit-4) + "\n\n" + "bb" يساوي الحد بالضبط فيبقى رسالة واحدة
+    assert bot.split_digest(["a" * (limit - 4), "bb"]) == ["a" * (limit - 4) + "\n\nbb"]
+    # حرف إضافي واحد يتجاوز الحد فتنقسم إلى رسالتين
+    assert bot.split_digest(["a" * (limit - 3), "bb"]) == ["a" * (limit - 3), "bb"]
+
+
+def test_split_digest_breaks_single_oversized_line():
+    limit = bot.TELEGRAM_MAX_MESSAGE_LENGTH
+    chunks = bot.split_digest(["short", "x" * (limit * 2 + 5), "tail"])
+    assert chunks == ["short", "x" * limit, "x" * limit, "x" * 5 + "\n\ntail"]
+
+
+def test_events_for_one_chat_are_sent_as_one_digest(monkeypatch, sent_messages):
+    user_id = add_user("100")
+    add_open_trade(user_id, "BTC-USDT")
+    add_open_trade(user_id, "ETH-USDT")
+    add_open_trade(add_user("200"), "BTC-USDT")
+    monkeypatch.setattr(bot, "get_current_price", lambda symbol: 94.0)  # تحت وقف الخسارة
+
+    bot.adaptive_monitor_tick()
+
+    by_chat = {}
+    for chat_id, text in sent_messages:
+        by_chat.setdefault(chat_id, []).append(text)
+    assert sorted(by_chat) == [100, 200]
+    assert len(by_chat[100]) == 1
+    assert "BTC-USDT" in by_chat[100][0] and "ETH-USDT" in by_chat[100][0]
+
+
+def test_tp1_and_tp2_in_same_pass_give_single_digest(monkeypatch, sent_messages):
+    add_open_trade(add_user("100"), "BTC-USDT")
+    monkeypatch.setattr(bot, "get_current_price", lambda symbol: 111.0)  # فوق TP1 و TP2
+
+    bot.adaptive_monitor_tick()
+
+    assert len(sent_messages) == 1
+    chat_id, text = sent_messages[0]
+    assert chat_id == 100
+    assert "4%" in text and "10%" in text
@@ -0,0 +1,55 @@
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import requests
+from werkzeug.serving import make_server
+
+import market_signals_bot as bot
+from conftest import add_user
+
+DUPLICATE_IPNS = 2000
+CONCURRENCY = 32
+
+
+@pytest.fixture
+def local_server():
+    server = make_server("127.0.0.1", 0, bot.app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}{bot.NOWPAYMENTS_ROUTE}"
+    server.shutdown()
+    thread.join()
+
+
+def test_duplicate_and_concurrent_ipns_activate_once(local_server, sent_messages):
+    add_user("100")
+    ipn = {
+        "payment_status": "finished",
+        "payment_id": "stress-1",
+        "pay_amount": 40,
+        "pay_currency": "usdt",
+        "order_description": json.dumps({"telegram_id": "100"}),
+    }
+    headers = {"x-nowpayments-sig": bot.NOWPAYMENTS_IPN_SECRET}
+    local = threading.local()
+
+    def replay(_):
+        # جلسة لكل خيط لإعادة استخدام الاتصال كما تفعل إعادة المحاولة من NowPayments
+        if not hasattr(local, "http"):
+            local.http = requests.Session()
+        return local.http.post(local_server, json=ipn, headers=headers, timeout=30).status_code
+
+    with ThreadPoolExecutor(max_workers=CONCURRENCY) as pool:
+        statuses = list(pool.map(replay, range(DUPLICATE_IPNS)))
+
+    assert statuses == [200] * DUPLICATE_IPNS
+    session = bot.SessionLocal()
+    try:
+        assert session.query(bot.Subscription).count() == 1
+        assert session.query(bot.ProcessedPayment).filter_by(payment_id="stress-1").count() == 1
+    finally:
+        session.close()
+    assert len(sent_messages) == 1
+    assert sent_messages[0][0] == 100
@@ -0,0 +1,33 @@
+import json
+
+import market_signals_bot as bot
+from query_profiler import assert_max_queries, profile_queries
+from conftest import add_user, telegram_update
+
+
+def test_status_stays_within_query_budget():
+    add_user("100", with_subscription=True)
+    with assert_max_queries(2, "/status"):
+        replies = bot.handle_telegram_update(telegram_update("100", "/status"))
+    assert len(replies) == 1
+    assert "strategy_advanced" in replies[0][1]
+
+
+def test_failed_statements_are_counted_and_not_leaked():
+    add_user("100")
+    ipn = {
+        "payment_status": "finished",
+        "payment_id": "dup-1",
+        "order_description": json.dumps({"telegram_id": "100"}),
+    }
+    bot.process_nowpayments_ipn(ipn)
+
+    with profile_queries("duplicate IPNs") as stats:
+        for _ in range(50):
+            response, status, notification = bot.process_nowpayments_ipn(ipn)
+            assert status == 200 and notification is None
+    # كل IPN مكرر ينفذ INSERT واحداً يفشل على الفهرس الفريد
+    assert stats.count == 50
+
+    with bot.engine.connect() as conn:
+        assert "query_start_time" not in conn.info